@@ -1,8 +1,9 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 
 """
 Setup and run Jupyter (for ParaTemp) on SCC from a local machine
 
+Requires Python 3.
 
 """
 
@@ -20,39 +21,52 @@ Setup and run Jupyter (for ParaTemp) on SCC from a local machine
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-from __future__ import print_function, division
-
 import argparse
+import atexit
 import getpass
+import importlib.util
 import json
 import logging
 try:
-    import pathlib
+    import orjson
 except ImportError:
-    import pathlib2 as pathlib
+    orjson = None
+import pathlib
 import re
-import select
-import signal
+import selectors
 import socket
-try:
-    import socketserver
-except ImportError:
-    import SocketServer as socketserver
+import socketserver
 import subprocess
 import sys
-import threading
+import time
 import webbrowser
 
-try:
-    import paramiko
-except ImportError:
-    subprocess.call([sys.executable, "-m", "pip", "install", 'paramiko'])
-    import paramiko
+# paramiko is only imported in ssh_connect(); it pulls in a lot of modules
+_HAS_PARAMIKO = importlib.util.find_spec('paramiko') is not None
 
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
+# Bytes to read per recv() call on sockets and SSH channels
+_RECV_SIZE = 65536
+# Most channel reads coalesced into one sendmsg() (well below IOV_MAX)
+_MAX_SEND_CHUNKS = 64
+# Kernel send/receive buffer size for the local (loopback) tunnel sockets
+_SOCK_BUFSIZE = 4 * 1024 * 1024
+
+_SETTINGS_PATH = pathlib.Path('~/Library/Application '
+                              'Support/ParaTemp/settings.json').expanduser()
+
+# Printed on SCC once the setup script is downloaded and executable
+_SCRIPT_READY = 'PARATEMP_SETUP_SCRIPT_READY'
+
+# ControlPath for the system ssh client (expanded by ssh itself)
+_SSH_CONTROL_PATH = '~/.ssh/cm-%r@%h:%p'
+
+# Matches the URL Jupyter prints on startup in raw (bytes) channel output
+_JUPYTER_RE = re.compile(rb'http(s)?://[^:\n]*:(\d+)/(?:\?token=(\w+))?')
+
 
 def _setup_log(level=logging.WARNING):
     global handler
@@ -68,12 +82,18 @@ class Config(dict):
 
     def __init__(self):
         log.debug('Initializing Config object')
-        self.path = pathlib.Path('~/Library/Application '
-                                 'Support/ParaTemp/settings.json').expanduser()
+        self.path = _SETTINGS_PATH
         self.temp_path = self.path.with_suffix('.json.new')
+        self._dirty = False
+        # in case a changed value never gets an explicit save()
+        atexit.register(self.save)
         if self.path.is_file():
             log.debug('Reading existing config from {}'.format(self.path))
-            d = json.load(self.path.open('r'))
+            if orjson is not None:
+                d = orjson.loads(self.path.read_bytes())
+            else:
+                with self.path.open('r') as f:
+                    d = json.load(f)
             super(Config, self).__init__(d)
         else:
             log.debug('No existing config found. Creating new')
@@ -91,27 +111,61 @@ class Config(dict):
         self['username'] = username
         self['Setup_on_SCC'] = False
         self['server'] = 'scc2.bu.edu'
+        self.save()
 
     def __setitem__(self, key, value):
+        super(Config, self).__setitem__(key, value)
+        self._dirty = True
+
+    def save(self):
+        """Write the config file if anything changed since the last save"""
+        if not self._dirty:
+            return
         try:
-            super(Config, self).__setitem__(key, value)
-            json.dump(self, self.temp_path.open('w'), indent=4)
+            if orjson is not None:
+                self.temp_path.write_bytes(
+                    orjson.dumps(dict(self), option=orjson.OPT_INDENT_2))
+            else:
+                with self.temp_path.open('w') as f:
+                    json.dump(self, f, indent=4)
             self.temp_path.rename(self.path)
         except Exception:
             log.exception('Exception raised when trying to write config file!')
             raise
+        self._dirty = False
 
 
 # Content for forwarding port mostly taken from paramiko forward.py demo
 #
 #
 
+def _tune_socket(sock):
+    """Disable Nagle and enlarge the kernel buffers of a local tunnel socket"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCK_BUFSIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCK_BUFSIZE)
+
+
 class ForwardServer(socketserver.ThreadingTCPServer):
     daemon_threads = True
     allow_reuse_address = True
 
+    def server_bind(self):
+        # must be set before listen() for the window to be advertised
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               _SOCK_BUFSIZE)
+        super(ForwardServer, self).server_bind()
+
 
 class Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        _tune_socket(self.request)
+        self.chan = None
+        self._closed = False
+        # reused for every read from the local socket
+        self._buf = bytearray(_RECV_SIZE)
+        self._view = memoryview(self._buf)
+
     def handle(self):
         try:
             chan = self.ssh_transport.open_channel(
@@ -132,31 +186,98 @@ class Handler(socketserver.BaseRequestHandler):
             )
             return
 
+        self.peername = self.request.getpeername()
         log.info(
             "Connected!  Tunnel open %r -> %r -> %r"
             % (
-                self.request.getpeername(),
+                self.peername,
                 chan.getpeername(),
                 (self.chain_host, self.chain_port),
             )
         )
-        while True:
-            r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
-                data = self.request.recv(1024)
-                if len(data) == 0:
-                    break
-                chan.send(data)
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
-
-        peername = self.request.getpeername()
-        chan.close()
-        self.request.close()
-        log.info("Tunnel closed from %r" % (peername,))
+        self.chan = chan
+        # os.splice() zero-copy isn't possible here: only the local end is a
+        # real socket, the channel is encrypted by paramiko in Python and
+        # its fileno() is just a readiness pipe
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.request, selectors.EVENT_READ)
+            selector.register(chan, selectors.EVENT_READ)
+            while not self._closed:
+                for key, events in selector.select():
+                    self.relay(key.fileobj)
+
+    def relay(self, source):
+        """Forward data that is ready on source (the socket or the channel)
+
+        Closes the tunnel once either end has closed or the transfer
+        fails."""
+        if self._closed:
+            # both ends were ready in the same select() batch
+            return
+        try:
+            if source is self.request:
+                still_open = self._forward_request()
+            else:
+                still_open = self._forward_chan()
+        except Exception as e:
+            log.error("Tunnel from %r failed: %r" % (self.peername, e))
+            still_open = False
+        if not still_open:
+            self.close()
+
+    def close(self):
+        # the server shuts down the local socket once handle() returns
+        if self._closed:
+            return
+        self._closed = True
+        self.chan.close()
+        log.info("Tunnel closed from %r" % (self.peername,))
+
+    def _forward_request(self):
+        """Forward data readable on the local socket to the channel
+
+        Returns False once the local end has closed the connection."""
+        n = self.request.recv_into(self._view)
+        if n == 0:
+            return False
+        self.chan.sendall(self._view[:n])
+        return True
+
+    def _forward_chan(self):
+        """Forward data buffered on the channel to the local socket
+
+        At most _MAX_SEND_CHUNKS reads are sent per call; the selector
+        reports the channel again if more is buffered.  Returns False once
+        the remote end has closed the channel."""
+        chunks = []
+        while len(chunks) < _MAX_SEND_CHUNKS:
+            # check before reading: any data sent before EOF is already
+            # buffered once eof_received is set
+            done = self.chan.eof_received or self.chan.closed
+            if not self.chan.recv_ready():
+                break
+            chunks.append(self.chan.recv(_RECV_SIZE))
+        else:
+            # batch is full, so there may be more data before any EOF
+            done = False
+        self._send_chunks(chunks)
+        return not done
+
+    def _send_chunks(self, chunks):
+        """Send chunks to the local socket
+
+        Several chunks are coalesced into a single sendmsg() call."""
+        if len(chunks) == 1 or not hasattr(self.request, 'sendmsg'):
+            for chunk in chunks:
+                self.request.sendall(chunk)
+            return
+        while chunks:
+            sent = self.request.sendmsg(chunks)
+            # drop the chunks that went out and trim a partially sent one
+            while chunks and sent >= len(chunks[0]):
+                sent -= len(chunks.pop(0))
+            if sent:
+                chunks[0] = chunks[0][sent:]
 
 
 def forward_tunnel(local_port, remote_host, remote_port, transport):
@@ -176,7 +297,70 @@ def forward_tunnel(local_port, remote_host, remote_port, transport):
 #
 # End of main part taken from paramiko forward.py demo
 
+def _openssh_forward_args(local_port, remote_host, remote_port):
+    """ssh arguments naming the forward and the ControlMaster to use"""
+    return ['-L', '{}:{}:{}'.format(local_port, remote_host, remote_port),
+            '-o', 'ControlPath={}'.format(_SSH_CONTROL_PATH),
+            '{}@{}'.format(config['username'], config['server'])]
+
+
+def openssh_tunnel(local_port, remote_host, remote_port):
+    """Forward local_port with the system ssh client instead of paramiko
+
+    OpenSSH does the encryption in native code and, with ControlMaster,
+    reuses an existing connection to the server if there is one.  It
+    authenticates separately, so it may prompt for the password again.
+    Use stop_openssh_tunnel() to remove the forward again."""
+    cmd = (['ssh', '-N',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ExitOnForwardFailure=yes'] +
+           _openssh_forward_args(local_port, remote_host, remote_port))
+    log.debug('Running: {}'.format(' '.join(cmd)))
+    return subprocess.Popen(cmd)
+
+
+def stop_openssh_tunnel(tunnel, local_port, remote_host, remote_port):
+    """Stop an openssh_tunnel() process and remove its forward
+
+    If a ControlMaster for the server already existed, the ssh process
+    was only a client of it and the forward lives on in the master, so
+    it has to be cancelled there explicitly."""
+    if tunnel.poll() is None:
+        tunnel.terminate()
+        tunnel.wait()
+    # fails harmlessly if there is no master (anymore)
+    subprocess.call(['ssh', '-O', 'cancel'] +
+                    _openssh_forward_args(local_port, remote_host,
+                                          remote_port),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _port_in_use(port):
+    """Return True if something on localhost accepts connections on port"""
+    try:
+        socket.create_connection(('localhost', port), timeout=1).close()
+    except OSError:
+        return False
+    return True
+
+
+def wait_for_forward(tunnel, local_port):
+    """Wait until the ssh process tunnel is accepting on local_port
+
+    local_port must be free before tunnel is started, otherwise whatever
+    else listens there is mistaken for the forward.  Returns False if ssh
+    exits first (e.g., authentication failed)."""
+    while tunnel.poll() is None:
+        if _port_in_use(local_port):
+            return True
+        time.sleep(0.5)
+    return False
+
+
 def ssh_connect():
+    if not _HAS_PARAMIKO:
+        subprocess.call([sys.executable, "-m", "pip", "install", 'paramiko'])
+    import paramiko
     _client = paramiko.SSHClient()
     _client.load_system_host_keys()
     password = getpass.getpass("Enter password for {} on {}: ".format(
@@ -194,6 +378,10 @@ def ssh_connect():
         sys.exit(1)
     finally:
         del password
+    # only disable Nagle: fixed buffer sizes would turn off the kernel's
+    # buffer autotuning on this long-distance connection
+    _client.get_transport().sock.setsockopt(socket.IPPROTO_TCP,
+                                            socket.TCP_NODELAY, 1)
     return _client
 
 
@@ -211,6 +399,11 @@ def parse_args():
     parser.add_argument('-l', '--log_level', default=30, type=int,
                         help='Level to write to log (smaller number writes '
                              'more)')
+    parser.add_argument('--openssh', action='store_true',
+                        help='Forward the Jupyter port with the system ssh '
+                             'client instead of paramiko. Faster for large '
+                             'transfers, but ssh may ask for the password '
+                             'again.')
     return parser.parse_args()
 
 
@@ -222,20 +415,34 @@ def scc_setup(dry=False):
     log.debug('Downloading SCC setup script to ~/.paratemp on SCC')
     scc_script_url = ('https://raw.githubusercontent.com/theavey/'
                       'paratemp-scc-setup/master/prep-for-paratemp.sh')
-    client.exec_command('mkdir -p .paratemp')
-    _stdout = client.exec_command('wget {} -O {}'.format(scc_script_url,
-                                                         scc_script_path))[1]
-    _stdout.channel.recv_exit_status()  # wait for it to finish
-    _stdout = client.exec_command('chmod +x {}'.format(scc_script_path))[1]
-    _stdout.channel.recv_exit_status()  # wait for it to finish
     if dry:
-        cl = './{} help'.format(scc_script_path)
+        script_args = '-i -n -d'
     else:
-        cl = './{} -i -n'.format(scc_script_path)
+        script_args = '-i -n'
+    # one chained command so only a single channel and exit status are
+    # needed; the marker tells a failed download apart from a failure in
+    # the setup script itself
+    cl = ('mkdir -p .paratemp && wget -nv {url} -O {path} && '
+          'chmod +x {path} && echo {marker} && '
+          './{path} {args}'.format(url=scc_script_url, path=scc_script_path,
+                                   marker=_SCRIPT_READY, args=script_args))
     _stdin, _stdout, _stderr = client.exec_command(cl)
-    log.debug('paratemp setup script said: {}\nerror message(s): {}'.format(
-        _stdout.read(), _stderr.read()))
+    out, err = _stdout.read(), _stderr.read()
+    status = _stdout.channel.recv_exit_status()
+    log.debug('paratemp setup script said: {}\nerror message(s): {}\n'
+              'exit status: {}'.format(out, err, status))
+    if _SCRIPT_READY.encode() not in out:
+        log.error('Could not download the setup script to SCC (exit status '
+                  '{}). stderr: {}'.format(status, err))
+        client.close()
+        sys.exit(1)
+    if status != 0:
+        log.warning('paratemp setup script exited with status {}; trying to '
+                    'start Jupyter anyway. stderr: {}'.format(status, err))
+    if dry:
+        return
     config['Setup_on_SCC'] = True
+    config.save()
 
 
 def main():
@@ -243,8 +450,11 @@ def main():
     args = parse_args()
     _setup_log(args.log_level)
     config = Config()
-    if args.server is not 'read_config':
+    if args.server != 'read_config':
         config['server'] = args.server
+    if args.username != 'read_config':
+        config['username'] = args.username
+    config.save()
     client = ssh_connect()
     scc_script_path = '.paratemp/prep-for-paratemp.sh'
     if not config['Setup_on_SCC']:
@@ -253,25 +463,28 @@ def main():
     # TODO change directory to ...?
     stdin, stdout, stderr = client.exec_command(
         './{} -s'.format(scc_script_path),
-        get_pty=True,  # kills command called on connection close
-        timeout=4)
+        get_pty=True)  # kills command called on connection close
+    # only read after the selector reports data, so recv() never has to wait
+    stdout.channel.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(stdout.channel.fileno(), selectors.EVENT_READ)
+    buf = bytearray()
     m = None
     try:
         while not m:
-            try:
-                log.debug('checking for new stdout...')
-                data = stdout.readline()
-            except socket.timeout:
-                continue
-            if data is not None:
-                log.debug('stdout: {}'.format(data))
+            log.debug('waiting for new stdout...')
+            sel.select(timeout=None)
+            data = stdout.channel.recv(_RECV_SIZE)
+            log.debug('stdout: {}'.format(data))
             if len(data) == 0:
                 raise ChannelClosed
-            data = str(data)
-            for line in data.split('\n'):
-                m = re.search(r'http(s)?://.*?:(\d+)/(?:\?token=(\w+))?', line)
-                if m is not None:
-                    break
+            buf += data
+            # only search complete lines so a half-received token can't match,
+            # then drop them so no output is scanned twice
+            end = buf.rfind(b'\n') + 1
+            m = _JUPYTER_RE.search(buf, 0, end)
+            if m is None:
+                del buf[:end]
     except ChannelClosed:
         log.error('Channel closed before finding Jupyter port. '
                   'stdout: {}\nstderr: '
@@ -282,30 +495,59 @@ def main():
         log.error('KeyboardInterrupt while finding Jupyter port. stderr: '
                   '{}'.format(stderr.read()))
         sys.exit(1)
-    log.info('found jupyter server info: port: {}   token: {}'.format(
-        m.group(2), m.group(2)))
+    finally:
+        sel.close()
     https = m.group(1)
     remote_port = int(m.group(2))
     token = m.group(3)
+    if token is not None:
+        token = token.decode('ascii')
+    log.info('found jupyter server info: port: {}   token: {}'.format(
+        remote_port, token))
     try:
         log.info("Now forwarding port {} to {}:{}".format(
             11111, config['server'], remote_port))
-        tunnel = forward_tunnel(11111, 'localhost', remote_port,
-                                client.get_transport())
-        thread = threading.Thread(target=tunnel.serve_forever)
-        thread.start()
+        if args.openssh:
+            if _port_in_use(11111):
+                # e.g. a forward left in a ControlMaster by an earlier run
+                log.error('Local port 11111 is already in use; not starting '
+                          'ssh port forwarding')
+                client.close()
+                sys.exit(1)
+            tunnel = openssh_tunnel(11111, 'localhost', remote_port)
+            # ssh may still be asking for a password, and the browser would
+            # only get "connection refused" (and steal the terminal's focus)
+            if not wait_for_forward(tunnel, 11111):
+                log.error('ssh port forwarding exited with status {}'.format(
+                    tunnel.returncode))
+                stop_openssh_tunnel(tunnel, 11111, 'localhost', remote_port)
+                client.close()
+                sys.exit(1)
+        else:
+            tunnel = forward_tunnel(11111, 'localhost', remote_port,
+                                    client.get_transport())
         https = 'http' if https is None else 'https'
         token = '' if token is None else '?token={}'.format(token)
         local_url = '{}://localhost:11111/{}'.format(https, token)
         log.info('local url to access jupyter: {}'.format(local_url))
         # TODO allow browser selection
         webbrowser.open(local_url)
-        signal.pause()
+        if args.openssh:
+            status = tunnel.wait()
+            log.error('ssh port forwarding exited with status {}'.format(
+                status))
+            stop_openssh_tunnel(tunnel, 11111, 'localhost', remote_port)
+            client.close()
+            sys.exit(1)
+        # serve from this thread so C-c interrupts it directly
+        tunnel.serve_forever()
     except KeyboardInterrupt:
         log.warning("C-c: Stopping port forwarding.")
-        tunnel.shutdown()
+        if args.openssh:
+            stop_openssh_tunnel(tunnel, 11111, 'localhost', remote_port)
+        else:
+            tunnel.server_close()
         client.close()
-        thread.join()
         sys.exit(0)
 
 
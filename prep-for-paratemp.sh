@@ -163,7 +163,7 @@ if [[ $SETUP = TRUE ]]; then
     SETUP_JUPYTER_CONFIG=$(cat <<-END
 	import json
 	from pathlib import Path
-        path = Path('~/.jupyter/jupyter_config.json').expanduser()
+	path = Path('~/.jupyter/jupyter_config.json').expanduser()
 	if path.is_file():
 	    config = json.load(path.open('r'))
 	else:
@@ -193,10 +193,11 @@ if [[ $SETUP = TRUE ]]; then
 	    if 'append_suffix' in line:
 	        line = 'append_suffix = no'
 	    out_lines.append(line)
+	text = '\\n'.join(out_lines)
 	if '${DRY}':
-	    print(f'.gromacswrapper.cfg would be {"\\n".join(out_lines)}')
+	    print(f'.gromacswrapper.cfg would be {text}')
 	else:
-	    path.write_text('\\n'.join(out_lines))
+	    path.write_text(text)
 	END
 	)
     python -c "$SETUP_GROMACSWRAPPER"